@@ -1,169 +1,182 @@
 import boto3
+from botocore.config import Config
 import json
+import orjson
+import gzip
 from datetime import datetime
 import os
-import pandas as pd
-from io import StringIO
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10}
+))
 BUCKET = 'weather-data-opem-weather-api'
 
-def delete_old_versions(bucket, prefix, keep_latest=True):
-    """Delete old versions of files, keeping only the latest if specified"""
-    try:
-        # List all objects with the given prefix
-        objects = s3.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', [])
-        
-        if not objects:
-            return 0
-        
-        # If we only want to keep the latest, find and delete all others
-        if keep_latest:
-            # Sort by LastModified (newest first)
-            sorted_objects = sorted(objects, key=lambda x: x['LastModified'], reverse=True)
-            latest = sorted_objects[0]
-            
-            deleted_count = 0
-            for obj in sorted_objects[1:]:
-                s3.delete_object(Bucket=bucket, Key=obj['Key'])
-                deleted_count += 1
-                print(f"Deleted old file: {obj['Key']}")
-            
-            return deleted_count
-        return 0
-        
-    except Exception as e:
-        print(f"Error in delete_old_versions: {str(e)}")
-        return 0
+# Columns of the processed current weather table, in output order. Types are fixed
+# rather than inferred so every day's Parquet file has the same schema for Athena.
+CURRENT_WEATHER_COLUMNS = [
+    ('City', 'string'), ('State', 'string'), ('Local_time', 'string'),
+    ('Current_temp_(C)', 'float64'), ('Feels_like_(C)', 'float64'),
+    ('Current_Weather', 'string'), ('Latitude', 'float64'), ('Longitude', 'float64'),
+    ('Wind_kph', 'float64'), ('Visibility_(km)', 'float64'), ('UV_index', 'float64'),
+    ('Alerts', 'string')
+]
+
+# Also write a JSON copy of the processed data to processed/current_weather_json/
+WRITE_JSON_COPY = os.environ.get('WRITE_JSON_COPY', 'false').lower() == 'true'
+
+# Ingestion already writes processed/current_weather/ from the data it fetched,
+# so this handler only re-reads the raw files from S3 when a replay is requested
+REPROCESS_ENABLED = os.environ.get('REPROCESS_CURRENT_WEATHER', 'false').lower() == 'true'
+
+def read_json_object(bucket, key):
+    """Download and parse a JSON object, decompressing it if it was stored gzipped"""
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    body = obj['Body'].read()
+    if obj.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    return orjson.loads(body)
+
+def get_latest_object(bucket, prefix):
+    """Return the newest object under prefix, or None if the prefix is empty.
+
+    Ingestion names raw files with a reverse timestamp, so S3's ascending key
+    order puts the newest file first and a single-key listing is enough.
+    """
+    objects = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get('Contents', [])
+    return objects[0] if objects else None
 
 def lambda_handler(event, context):
     try:
+        # Skip unless reprocessing is enabled or asked for explicitly in the event
+        if not (REPROCESS_ENABLED or (isinstance(event, dict) and event.get('reprocess'))):
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'Current weather is produced by the ingestion Lambda; reprocessing skipped'
+                })
+            }
+        
+        # Imported here so the default no-op path doesn't pay for pyarrow on cold start
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
         # Get current date in the format used in the S3 paths
         current_date = datetime.now().strftime("%Y-%m-%d")
         
         # Get the latest forecast and alert files from S3 with date prefix
-        forecast_files = s3.list_objects_v2(
-            Bucket=BUCKET,
-            Prefix=f'to_be_processed/forecast/{current_date}/'
-        ).get('Contents', [])
-        
-        alert_files = s3.list_objects_v2(
-            Bucket=BUCKET,
-            Prefix=f'to_be_processed/alert/{current_date}/'
-        ).get('Contents', [])
+        latest_forecast = get_latest_object(BUCKET, f'to_be_processed/forecast/{current_date}/')
+        latest_alert = get_latest_object(BUCKET, f'to_be_processed/alert/{current_date}/')
 
-        if not forecast_files:
+        if latest_forecast is None:
             return {
                 'statusCode': 404,
                 'body': json.dumps(f"No forecast files found for date {current_date}")
             }
             
-        if not alert_files:
+        if latest_alert is None:
             return {
                 'statusCode': 404,
                 'body': json.dumps(f"No alert files found for date {current_date}")
             }
 
-        # Sort by last modified time and pick the most recent
-        latest_forecast = max(forecast_files, key=lambda x: x['LastModified'])
-        latest_alert = max(alert_files, key=lambda x: x['LastModified'])
-
         # Download and load JSON data
-        forecast_obj = s3.get_object(Bucket=BUCKET, Key=latest_forecast['Key'])
-        alert_obj = s3.get_object(Bucket=BUCKET, Key=latest_alert['Key'])
+        forecast_dict = read_json_object(BUCKET, latest_forecast['Key'])
+        alert_dict = read_json_object(BUCKET, latest_alert['Key'])
         
-        forecast_dict = json.loads(forecast_obj['Body'].read().decode('utf-8'))
-        alert_dict = json.loads(alert_obj['Body'].read().decode('utf-8'))
+        # Ingestion saves lists of API responses; key them by city name
+        if isinstance(forecast_dict, list):
+            forecast_dict = {data['location']['name']: data for data in forecast_dict}
+        if isinstance(alert_dict, list):
+            # First match per location name wins, as in Ingestion
+            alerts_by_location = {}
+            for alert in alert_dict:
+                if isinstance(alert, dict):
+                    alerts_by_location.setdefault(alert.get('location', {}).get('name'), alert)
+            alert_dict = alerts_by_location
 
-        current_list = []
+        # One list per column, so Arrow can build the table directly
+        # instead of transposing a list of row dicts
+        cities, states, local_times = [], [], []
+        current_temps, feels_likes, current_weathers = [], [], []
+        latitudes, longitudes, wind_kphs = [], [], []
+        visibilities, uv_indexes, alerts_texts = [], [], []
         
         # Process each city's forecast data
         for city_name, city_data in forecast_dict.items():
+            cities.append(city_name)
+            
             # Extract current weather parameters
-            current_temp = city_data['current']['temp_c']
-            feels_like = city_data['current']['feelslike_c']
-            current_weather = city_data['current']['condition']['text']
-            wind_kph = city_data['current']['wind_kph']
-            visibility = city_data['current']['vis_km']
-            uv_index = city_data['current']['uv']
+            current = city_data['current']
+            current_temps.append(current['temp_c'])
+            feels_likes.append(current['feelslike_c'])
+            current_weathers.append(current['condition']['text'])
+            wind_kphs.append(current['wind_kph'])
+            visibilities.append(current['vis_km'])
+            uv_indexes.append(current['uv'])
             
             # Extract location data
             location = city_data['location']
-            state_name = location['region']
-            local_time = location['localtime']
-            latitude = location['lat']
-            longitude = location['lon']
+            states.append(location['region'])
+            local_times.append(location['localtime'])
+            latitudes.append(location['lat'])
+            longitudes.append(location['lon'])
             
-            # Extract alerts (default to "No alerts" if none exist)
-            city_alerts = alert_dict.get(city_name, {}).get('alerts', {}).get('alert', [])
-            alerts_text = "No alerts" if not city_alerts else str(city_alerts)
-            
-            current_element = {
-                'City': city_name,
-                'State': state_name,
-                'Local_time': local_time,
-                'Current_temp_(C)': current_temp,
-                'Feels_like_(C)': feels_like,
-                'Current_Weather': current_weather,
-                'Latitude': latitude,
-                'Longitude': longitude,
-                'Wind_kph': wind_kph,
-                'Visibility_(km)': visibility,
-                'UV_index': uv_index,
-                'Alerts': alerts_text
-            }
-            current_list.append(current_element)
-
-        # Generate timestamp for the new files
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        processed_prefix = f"processed/current_weather/{current_date}/"
+            # Join alert descriptions the same way Ingestion does (default to "No alerts")
+            alerts_text = "No alerts"
+            alert = alert_dict.get(city_name)
+            if isinstance(alert, dict) and 'alerts' in alert:
+                alerts = alert['alerts'].get('alert', [])
+                if alerts:
+                    alerts_text = " | ".join([a.get('description', '') for a in alerts])
+            alerts_texts.append(alerts_text)
         
-        # Create DataFrame for CSV conversion
-        df = pd.DataFrame(current_list)
-        
-        # Save JSON file
-        json_key = f"{processed_prefix}current_weather_{timestamp}.json"
-        s3.put_object(
-            Bucket=BUCKET,
-            Key=json_key,
-            Body=json.dumps(current_list),
-            ContentType='application/json'
+        schema = pa.schema(CURRENT_WEATHER_COLUMNS)
+        columns = (
+            cities, states, local_times, current_temps, feels_likes, current_weathers,
+            latitudes, longitudes, wind_kphs, visibilities, uv_indexes, alerts_texts
+        )
+        current_batch = pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema
         )
+
+        # Fixed file names; old versions are expired by s3_lifecycle.json
+        processed_prefix = f"processed/current_weather/{current_date}/"
         
-        # Save CSV file (better for Athena)
-        csv_key = f"{processed_prefix}current_weather_{timestamp}.csv"
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
+        # Save Parquet file (columnar and compressed, so Athena scans fewer bytes)
+        parquet_key = f"{processed_prefix}current_weather.parquet"
+        parquet_buffer = pa.BufferOutputStream()
+        pq.write_table(pa.Table.from_batches([current_batch]), parquet_buffer, compression='snappy')
         s3.put_object(
             Bucket=BUCKET,
-            Key=csv_key,
-            Body=csv_buffer.getvalue(),
-            ContentType='text/csv'
+            Key=parquet_key,
+            Body=parquet_buffer.getvalue().to_pybytes(),
+            ContentType='application/octet-stream'
         )
+        processed_locations = {'parquet': f"s3://{BUCKET}/{parquet_key}"}
         
-        # Clean up old processed files (keep only latest)
-        deleted_processed_count = delete_old_versions(BUCKET, processed_prefix)
-        
-        # Clean up old raw forecast files (keep only latest)
-        deleted_forecast_count = delete_old_versions(BUCKET, f"to_be_processed/forecast/{current_date}/")
-        
-        # Clean up old raw alert files (keep only latest)
-        deleted_alert_count = delete_old_versions(BUCKET, f"to_be_processed/alert/{current_date}/")
+        # Save gzipped JSON file only if a JSON copy is requested, in its own folder
+        # so the Parquet-only Athena table never sees it
+        if WRITE_JSON_COPY:
+            json_key = f"processed/current_weather_json/{current_date}/current_weather.json.gz"
+            s3.put_object(
+                Bucket=BUCKET,
+                Key=json_key,
+                Body=gzip.compress(orjson.dumps(current_batch.to_pylist()), compresslevel=1),
+                ContentType='application/json',
+                ContentEncoding='gzip'
+            )
+            processed_locations['json'] = f"s3://{BUCKET}/{json_key}"
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Current weather data processed successfully',
-                'processed_locations': {
-                    'json': f"s3://{BUCKET}/{json_key}",
-                    'csv': f"s3://{BUCKET}/{csv_key}"
-                },
-                'cleanup_stats': {
-                    'deleted_processed_files': deleted_processed_count,
-                    'deleted_forecast_files': deleted_forecast_count,
-                    'deleted_alert_files': deleted_alert_count
-                },
-                'total_deleted': deleted_processed_count + deleted_forecast_count + deleted_alert_count
+                'processed_locations': processed_locations,
+                'cleanup_stats': {},
+                'total_deleted': 0
             })
         }
         
@@ -1,29 +1,48 @@
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 import json
+import orjson
+import gzip
 from datetime import datetime
-import csv
-from io import StringIO
+import re
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10}
+))
 BUCKET = 'weather-data-opem-weather-api'
 
+# Uploads are already fanned out across a thread pool, so don't nest another one per file
+TRANSFER_CONFIG = TransferConfig(use_threads=False)
+
+# CSV headers, with the same \r\n line ending csv.writer used to emit
+LOCATION_CSV_HEADER = "Location,Region,Country,Latitude,Longitude,Time Zone\r\n"
+FORECAST_CSV_HEADER = (
+    "Date,Max Temp (C),Min Temp (C),Avg Temp (C),Total Precip (mm),Chance of Rain,"
+    "Condition,Max Wind (kph),Avg Humidity,UV Index,Hourly Temperatures (JSON)\r\n"
+)
+
 # List of expected city names
 EXPECTED_CITIES = ['perth', 'melbourne', 'sydney', 'brisbane', 'adelaide']
+EXPECTED_SET = frozenset(EXPECTED_CITIES)
+_CITY_RE = re.compile('|'.join(EXPECTED_CITIES))
 
 def process_city_forecast(city_name, city_data):
     """Processes weather forecast data for a city into structured JSON"""
     forecast_days = []
+    append_day = forecast_days.append
     
     for forecast_day in city_data['forecast']['forecastday']:
         day_data = forecast_day['day']
         
-        # Process hourly temperatures
-        hourly_temps = {}
-        for hour in forecast_day['hour']:
-            time = hour['time'].split()[1]  # Extract HH:00
-            hourly_temps[time] = hour['temp_c']
+        # Process hourly temperatures ('YYYY-MM-DD HH:MM' -> 'HH:MM')
+        hourly_temps = {hour['time'][11:16]: hour['temp_c'] for hour in forecast_day['hour']}
         
-        forecast_days.append({
+        append_day({
             'date': forecast_day['date'],
             'daily_summary': {
                 'max_temp_c': day_data['maxtemp_c'],
@@ -39,181 +58,154 @@ def process_city_forecast(city_name, city_data):
             'hourly_temperatures': hourly_temps
         })
     
+    loc = city_data['location']
     return {
         'location': {
-            'name': city_data['location']['name'],
-            'region': city_data['location']['region'],
-            'country': city_data['location']['country'],
-            'lat': city_data['location']['lat'],
-            'lon': city_data['location']['lon'],
-            'tz_id': city_data['location']['tz_id']
+            'name': loc['name'],
+            'region': loc['region'],
+            'country': loc['country'],
+            'lat': loc['lat'],
+            'lon': loc['lon'],
+            'tz_id': loc['tz_id']
         },
         'forecast_days': forecast_days,
         'last_processed': datetime.now().isoformat()
     }
 
+def gzip_buffer(data):
+    """Gzip bytes into a file object for upload (level 1: nearly all the size win, little CPU)"""
+    return BytesIO(gzip.compress(data, compresslevel=1))
+
+def read_json_object(bucket, key):
+    """Download and parse a JSON object, decompressing it if it was stored gzipped"""
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    body = obj['Body'].read()
+    if obj.get('ContentEncoding') == 'gzip':
+        body = gzip.decompress(body)
+    return orjson.loads(body)
+
+def convert_to_json(data):
+    """Convert processed forecast data to a gzipped JSON file object"""
+    return gzip_buffer(orjson.dumps(data))
+
+def csv_field(value):
+    """Format a field the same way csv.writer's default dialect would (None -> empty)"""
+    if value is None:
+        return ''
+    if not isinstance(value, str):
+        value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
 def convert_to_csv(data):
-    """Convert processed forecast data to CSV format"""
-    # Create CSV for location data
-    location_csv = StringIO()
-    location_writer = csv.writer(location_csv)
-    location_writer.writerow(['Location', 'Region', 'Country', 'Latitude', 'Longitude', 'Time Zone'])
-    location_writer.writerow([
-        data['location']['name'],
-        data['location']['region'],
-        data['location']['country'],
-        data['location']['lat'],
-        data['location']['lon'],
-        data['location']['tz_id']
-    ])
-    
-    # Create CSV for forecast data
-    forecast_csv = StringIO()
-    forecast_writer = csv.writer(forecast_csv)
+    """Convert processed forecast data to gzipped CSV file objects"""
+    # Location data is a single row
+    loc = data['location']
+    location_csv = (
+        f"{LOCATION_CSV_HEADER}"
+        f"{csv_field(loc['name'])},{csv_field(loc['region'])},{csv_field(loc['country'])},"
+        f"{csv_field(loc['lat'])},{csv_field(loc['lon'])},{csv_field(loc['tz_id'])}\r\n"
+    )
     
-    # Write forecast header
-    forecast_writer.writerow([
-        'Date', 'Max Temp (C)', 'Min Temp (C)', 'Avg Temp (C)', 
-        'Total Precip (mm)', 'Chance of Rain', 'Condition',
-        'Max Wind (kph)', 'Avg Humidity', 'UV Index',
-        'Hourly Temperatures (JSON)'
-    ])
-    
-    # Write forecast rows
+    # Format each row directly instead of going through csv.writer
+    lines = [FORECAST_CSV_HEADER]
+    append_line = lines.append
     for day in data['forecast_days']:
-        forecast_writer.writerow([
-            day['date'],
-            day['daily_summary']['max_temp_c'],
-            day['daily_summary']['min_temp_c'],
-            day['daily_summary']['avg_temp_c'],
-            day['daily_summary']['total_precip_mm'],
-            day['daily_summary']['chance_of_rain'],
-            day['daily_summary']['condition'],
-            day['daily_summary']['max_wind_kph'],
-            day['daily_summary']['avg_humidity'],
-            day['daily_summary']['uv_index'],
-            json.dumps(day['hourly_temperatures'])
-        ])
+        summary = day['daily_summary']
+        append_line(
+            f"{csv_field(day['date'])},{csv_field(summary['max_temp_c'])},{csv_field(summary['min_temp_c'])},"
+            f"{csv_field(summary['avg_temp_c'])},{csv_field(summary['total_precip_mm'])},"
+            f"{csv_field(summary['chance_of_rain'])},{csv_field(summary['condition'])},"
+            f"{csv_field(summary['max_wind_kph'])},{csv_field(summary['avg_humidity'])},"
+            f"{csv_field(summary['uv_index'])},"
+            f"{csv_field(json.dumps(day['hourly_temperatures']))}\r\n"
+        )
     
     return {
-        'location': location_csv.getvalue(),
-        'forecast': forecast_csv.getvalue()
+        'location': gzip_buffer(location_csv.encode('utf-8')),
+        'forecast': gzip_buffer(''.join(lines).encode('utf-8'))
     }
 
-def delete_old_versions(bucket, prefix, keep_latest=True):
-    """Delete old versions of files, keeping only the latest if specified"""
-    try:
-        objects = s3.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', [])
-        if not objects:
-            return 0
-        
-        if keep_latest:
-            sorted_objects = sorted(objects, key=lambda x: x['LastModified'], reverse=True)
-            deleted_count = 0
-            for obj in sorted_objects[1:]:
-                s3.delete_object(Bucket=bucket, Key=obj['Key'])
-                deleted_count += 1
-                print(f"Deleted old file: {obj['Key']}")
-            return deleted_count
-        return 0
-        
-    except Exception as e:
-        print(f"Error in delete_old_versions: {str(e)}")
-        return 0
-
 def get_city_name(city_data):
     """Extract and normalize city name from the data"""
     name = city_data['location']['name'].lower()
     
-    # Check if the name matches our expected cities
-    for expected in EXPECTED_CITIES:
-        if expected in name:
-            return expected
+    # Check if the name contains one of our expected cities
+    match = _CITY_RE.search(name)
+    if match:
+        return match.group(0)
     
     # If not found, use the name but sanitize it
     return name.replace(" ", "_")
 
+def get_latest_object(bucket, prefix):
+    """Return the newest object under prefix, or None if the prefix is empty.
+
+    Ingestion names raw files with a reverse timestamp, so S3's ascending key
+    order puts the newest file first and a single-key listing is enough.
+    """
+    objects = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get('Contents', [])
+    return objects[0] if objects else None
+
 def lambda_handler(event, context):
     try:
         current_date = datetime.now().strftime("%Y-%m-%d")
         
         # Get the latest forecast file from S3
-        forecast_files = s3.list_objects_v2(
-            Bucket=BUCKET,
-            Prefix=f'to_be_processed/forecast/{current_date}/'
-        ).get('Contents', [])
+        latest_forecast = get_latest_object(BUCKET, f'to_be_processed/forecast/{current_date}/')
         
-        if not forecast_files:
+        if latest_forecast is None:
             return {
                 'statusCode': 404,
                 'body': json.dumps(f"No forecast files found for date {current_date}")
             }
         
-        latest_forecast = max(forecast_files, key=lambda x: x['LastModified'])
-        forecast_obj = s3.get_object(Bucket=BUCKET, Key=latest_forecast['Key'])
-        forecast_data = json.loads(forecast_obj['Body'].read().decode('utf-8'))
+        forecast_data = read_json_object(BUCKET, latest_forecast['Key'])
         
         # Handle different input formats
         if isinstance(forecast_data, list):
             # Convert list to dict with proper city names
             forecast_data = {get_city_name(data): data for data in forecast_data}
         elif isinstance(forecast_data, dict):
-            # Ensure keys are proper city names
-            forecast_data = {get_city_name(data): data for key, data in forecast_data.items()}
+            # Ensure keys are proper city names, rebuilding only if some aren't already
+            if not EXPECTED_SET.issuperset(forecast_data):
+                forecast_data = {get_city_name(data): data for data in forecast_data.values()}
         else:
             raise ValueError("Unexpected forecast data format")
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         processed_cities = []
-        files_created = 0
+        uploads = []  # (key, file object, content_type)
         
         # Process each city's data
         for city_name, city_data in forecast_data.items():
             processed_data = process_city_forecast(city_name, city_data)
             processed_cities.append(city_name)
             
-            # Create folder name like 'perth_forecast'
+            # Create folder name like 'perth_forecast' (fixed file names, see s3_lifecycle.json)
             prefix = f"processed/{city_name}_forecast/{current_date}/"
             
-            # Upload JSON
-            json_key = f"{prefix}forecast_{timestamp}.json"
-            s3.put_object(
-                Bucket=BUCKET,
-                Key=json_key,
-                Body=json.dumps(processed_data, indent=2),
-                ContentType='application/json'
-            )
-            files_created += 1
+            # Queue JSON (all bodies are gzipped; Athena picks the codec from the .gz suffix)
+            uploads.append((f"{prefix}forecast.json.gz", convert_to_json(processed_data), 'application/json'))
             
-            # Upload CSVs
+            # Queue CSVs
             csv_data = convert_to_csv(processed_data)
-            
-            location_csv_key = f"{prefix}location_{timestamp}.csv"
-            s3.put_object(
-                Bucket=BUCKET,
-                Key=location_csv_key,
-                Body=csv_data['location'],
-                ContentType='text/csv'
-            )
-            files_created += 1
-            
-            forecast_csv_key = f"{prefix}forecast_{timestamp}.csv"
-            s3.put_object(
-                Bucket=BUCKET,
-                Key=forecast_csv_key,
-                Body=csv_data['forecast'],
-                ContentType='text/csv'
-            )
-            files_created += 1
-            
-            # Clean up old versions
-            deleted_count = delete_old_versions(BUCKET, prefix)
-            print(f"Deleted {deleted_count} old files for {city_name}")
+            uploads.append((f"{prefix}location.csv.gz", csv_data['location'], 'text/csv'))
+            uploads.append((f"{prefix}forecast.csv.gz", csv_data['forecast'], 'text/csv'))
         
-        # Clean up raw forecast files
-        raw_prefix = f"to_be_processed/forecast/{current_date}/"
-        deleted_raw_count = delete_old_versions(BUCKET, raw_prefix)
-        print(f"Deleted {deleted_raw_count} old raw forecast files")
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            # Upload all files concurrently; each city writes to its own prefix
+            futures = [
+                executor.submit(
+                    s3.upload_fileobj, body, BUCKET, key,
+                    ExtraArgs={'ContentType': content_type, 'ContentEncoding': 'gzip'},
+                    Config=TRANSFER_CONFIG
+                )
+                for key, body, content_type in uploads
+            ]
+            for future in futures:
+                future.result()
+            files_created = len(uploads)
         
         return {
             'statusCode': 200,
@@ -221,7 +213,7 @@ def lambda_handler(event, context):
                 'message': 'Forecast data processed successfully',
                 'processed_cities': processed_cities,
                 'files_created': files_created,
-                'files_deleted': deleted_raw_count,
+                'files_deleted': 0,
                 'processing_date': current_date
             })
         }
@@ -1,76 +1,107 @@
 import boto3
+from botocore.config import Config
 import json
+import orjson
+import gzip
 from datetime import datetime
+import logging
 import os
-import pandas as pd
-from io import StringIO
-import http.client
+import pyarrow as pa
+import pyarrow.parquet as pq
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    retries={'mode': 'adaptive', 'max_attempts': 10}
+))
 BUCKET = 'weather-data-opem-weather-api'
 
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
 # Weather API Configuration
 API_HOST = "weatherapi-com.p.rapidapi.com"
 API_KEY = os.environ['API_KEY']
 CITIES = ["Perth", "Melbourne", "Sydney", "Brisbane", "Adelaide"]
 
+# Columns of the processed current weather table, in output order. Types are fixed
+# rather than inferred so every day's Parquet file has the same schema for Athena.
+CURRENT_WEATHER_COLUMNS = [
+    ('City', 'string'), ('State', 'string'), ('Local_time', 'string'),
+    ('Current_temp_(C)', 'float64'), ('Feels_like_(C)', 'float64'),
+    ('Current_Weather', 'string'), ('Latitude', 'float64'), ('Longitude', 'float64'),
+    ('Wind_kph', 'float64'), ('Visibility_(km)', 'float64'), ('UV_index', 'float64'),
+    ('Alerts', 'string')
+]
+
+# Also write a JSON copy of the processed data to processed/current_weather_json/
+WRITE_JSON_COPY = os.environ.get('WRITE_JSON_COPY', 'false').lower() == 'true'
+
 headers = {
     'x-rapidapi-key': API_KEY,
     'x-rapidapi-host': API_HOST
 }
 
+# Keep-alive connection pool shared by all worker threads and warm invocations
+http_pool = urllib3.PoolManager(maxsize=10)
+
 def get_weather_data(city, endpoint):
     """Fetch weather data from API for a specific city and endpoint"""
-    conn = http.client.HTTPSConnection(API_HOST)
-    try:
-        conn.request("GET", f"/{endpoint}.json?q={city}", headers=headers)
-        res = conn.getresponse()
-        data = json.loads(res.read().decode('utf-8'))
-        return data
-    finally:
-        conn.close()
+    res = http_pool.request(
+        "GET",
+        f"https://{API_HOST}/{endpoint}.json",
+        fields={'q': city},
+        headers=headers
+    )
+    data = orjson.loads(res.data)
+    return data
 
-def delete_old_versions(bucket, prefix, keep_latest=True):
-    """Delete old versions of files, keeping only the latest if specified"""
+def get_alert_data(city):
+    """Fetch alert data for a city, returning an error record on failure"""
     try:
-        objects = s3.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', [])
-        
-        if not objects:
-            return 0
-        
-        if keep_latest:
-            sorted_objects = sorted(objects, key=lambda x: x['LastModified'], reverse=True)
-            deleted_count = 0
-            for obj in sorted_objects[1:]:
-                s3.delete_object(Bucket=bucket, Key=obj['Key'])
-                deleted_count += 1
-                print(f"Deleted old file: {obj['Key']}")
-            return deleted_count
-        return 0
-        
+        return get_weather_data(city, 'alerts')  # Assuming 'alerts' endpoint exists
     except Exception as e:
-        print(f"Error in delete_old_versions: {str(e)}")
-        return 0
+        logger.warning("Failed to get alerts for %s: %s", city, e)
+        return {'city': city, 'error': str(e)}
 
-def save_to_s3(bucket, prefix, data, file_type='json'):
-    """Save data to S3 with timestamp"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    key = f"{prefix}{file_type}_data_{timestamp}.{file_type}"
+def reverse_timestamp(now):
+    """Key prefix that makes S3 list the newest file first under a prefix"""
+    return f"{9999999999 - int(now.timestamp()):010d}"
+
+def save_to_s3(bucket, prefix, data, file_type='json', name=None):
+    """Save data to S3 under a fixed name if given, otherwise with timestamp.
+
+    Parquet data must be a pyarrow Table; JSON data is any JSON-serializable object.
+    """
+    if name is not None:
+        key = f"{prefix}{name}.{file_type}"
+    else:
+        now = datetime.now()
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
+        # Reverse timestamp first so consumers can fetch the latest with MaxKeys=1
+        key = f"{prefix}{reverse_timestamp(now)}_{file_type}_data_{timestamp}.{file_type}"
     
+    extra_args = {}
     if file_type == 'json':
-        body = json.dumps(data)
+        # Level 1 gets nearly all of the size win on repetitive JSON for little CPU
+        body = gzip.compress(orjson.dumps(data), compresslevel=1)
         content_type = 'application/json'
-    elif file_type == 'csv':
-        csv_buffer = StringIO()
-        pd.DataFrame(data).to_csv(csv_buffer, index=False)
-        body = csv_buffer.getvalue()
-        content_type = 'text/csv'
+        extra_args['ContentEncoding'] = 'gzip'
+        key += '.gz'
+    elif file_type == 'parquet':
+        parquet_buffer = pa.BufferOutputStream()
+        pq.write_table(data, parquet_buffer, compression='snappy')
+        body = parquet_buffer.getvalue().to_pybytes()
+        content_type = 'application/octet-stream'
     
     s3.put_object(
         Bucket=bucket,
         Key=key,
         Body=body,
-        ContentType=content_type
+        ContentType=content_type,
+        **extra_args
     )
     return key
 
@@ -78,89 +109,92 @@ def lambda_handler(event, context):
     try:
         current_date = datetime.now().strftime("%Y-%m-%d")
         
-        # Fetch and save forecast data
-        forecast_data = []
-        for city in CITIES:
-            forecast = get_weather_data(city, 'forecast')
-            forecast_data.append(forecast)
+        # Fetch forecast and alert data for all cities concurrently
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            forecast_futures = {city: executor.submit(get_weather_data, city, 'forecast') for city in CITIES}
+            alert_futures = {city: executor.submit(get_alert_data, city) for city in CITIES}
+            forecast_by_city = {city: future.result() for city, future in forecast_futures.items()}
+            alert_by_city = {city: future.result() for city, future in alert_futures.items()}
         
+        # Save forecast data
+        forecast_data = [forecast_by_city[city] for city in CITIES]
         forecast_prefix = f"to_be_processed/forecast/{current_date}/"
         forecast_key = save_to_s3(BUCKET, forecast_prefix, forecast_data, 'json')
         
-        # Fetch and save alert data
-        alert_data = []
-        for city in CITIES:
-            try:
-                alert = get_weather_data(city, 'alerts')  # Assuming 'alerts' endpoint exists
-                alert_data.append(alert)
-            except Exception as e:
-                print(f"Failed to get alerts for {city}: {str(e)}")
-                alert_data.append({'city': city, 'error': str(e)})
-        
+        # Save alert data
+        alert_data = [alert_by_city[city] for city in CITIES]
         alert_prefix = f"to_be_processed/alert/{current_date}/"
         alert_key = save_to_s3(BUCKET, alert_prefix, alert_data, 'json')
         
-        # Process the data into final format
-        current_list = []
+        # Index alerts by location name (first match wins) for O(1) lookup per city
+        alerts_by_location = {}
+        for alert in alert_data:
+            if isinstance(alert, dict):
+                alerts_by_location.setdefault(alert.get('location', {}).get('name'), alert)
+        
+        # Process the data into final format, one list per column so Arrow can
+        # build the table directly instead of transposing a list of row dicts
+        cities, states, local_times = [], [], []
+        current_temps, feels_likes, current_weathers = [], [], []
+        latitudes, longitudes, wind_kphs = [], [], []
+        visibilities, uv_indexes, alerts_texts = [], [], []
         for city_data in forecast_data:
-            city_name = city_data['location']['name']
-            state_name = city_data['location']['region']
-            local_time = city_data['location']['localtime']
-            current_temp = city_data['current']['temp_c']
-            feels_like = city_data['current']['feelslike_c']
-            current_weather = city_data['current']['condition']['text']
-            latitude = city_data['location']['lat']
-            longitude = city_data['location']['lon']
-            wind_kph = city_data['current']["wind_kph"]
-            visibility = city_data['current']['vis_km']
-            UV_index = city_data['current']['uv']
+            location = city_data['location']
+            current = city_data['current']
+            city_name = location['name']
+            cities.append(city_name)
+            states.append(location['region'])
+            local_times.append(location['localtime'])
+            current_temps.append(current['temp_c'])
+            feels_likes.append(current['feelslike_c'])
+            current_weathers.append(current['condition']['text'])
+            latitudes.append(location['lat'])
+            longitudes.append(location['lon'])
+            wind_kphs.append(current['wind_kph'])
+            visibilities.append(current['vis_km'])
+            uv_indexes.append(current['uv'])
             
             # Find matching alert data
             alerts_text = "No alerts"
-            for alert in alert_data:
-                if isinstance(alert, dict) and alert.get('location', {}).get('name') == city_name:
-                    if 'alerts' in alert:
-                        alerts = alert['alerts'].get('alert', [])
-                        alerts_text = " | ".join([a.get('description', '') for a in alerts]) if alerts else "No alerts"
-                    break
-            
-            current_element = {
-                'City': city_name, 'State': state_name, 'Local_time': local_time,
-                'Current_temp_(C)': current_temp, 'Feels_like_(C)': feels_like,
-                'Current_Weather': current_weather, 'Latitude': latitude,
-                'Longitude': longitude, 'Wind_kph': wind_kph,
-                'Visibility_(km)': visibility, 'UV_index': UV_index,
-                'Alerts': alerts_text
-            }
-            current_list.append(current_element)
+            alert = alerts_by_location.get(city_name)
+            if alert is not None and 'alerts' in alert:
+                alerts = alert['alerts'].get('alert', [])
+                if alerts:
+                    alerts_text = " | ".join([a.get('description', '') for a in alerts])
+            alerts_texts.append(alerts_text)
         
-        # Save processed data
-        processed_prefix = f"processed/current_weather/{current_date}/"
-        json_key = save_to_s3(BUCKET, processed_prefix, current_list, 'json')
-        csv_key = save_to_s3(BUCKET, processed_prefix, current_list, 'csv')
+        schema = pa.schema(CURRENT_WEATHER_COLUMNS)
+        columns = (
+            cities, states, local_times, current_temps, feels_likes, current_weathers,
+            latitudes, longitudes, wind_kphs, visibilities, uv_indexes, alerts_texts
+        )
+        current_batch = pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema
+        )
         
-        # Clean up old files
-        deleted_forecast = delete_old_versions(BUCKET, f"to_be_processed/forecast/{current_date}/")
-        deleted_alerts = delete_old_versions(BUCKET, f"to_be_processed/alert/{current_date}/")
-        deleted_processed = delete_old_versions(BUCKET, processed_prefix)
+        # Save processed data (Parquet for Athena, JSON copy only if enabled) under a fixed name
+        processed_prefix = f"processed/current_weather/{current_date}/"
+        parquet_key = save_to_s3(
+            BUCKET, processed_prefix, pa.Table.from_batches([current_batch]), 'parquet', name='current_weather'
+        )
+        processed_locations = {'parquet': f"s3://{BUCKET}/{parquet_key}"}
+        if WRITE_JSON_COPY:
+            # Separate folder so the Parquet-only Athena table never sees the JSON file
+            json_prefix = f"processed/current_weather_json/{current_date}/"
+            json_key = save_to_s3(BUCKET, json_prefix, current_batch.to_pylist(), 'json', name='current_weather')
+            processed_locations['json'] = f"s3://{BUCKET}/{json_key}"
         
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Weather data processed successfully',
-                'processed_locations': {
-                    'json': f"s3://{BUCKET}/{json_key}",
-                    'csv': f"s3://{BUCKET}/{csv_key}"
-                },
+                'processed_locations': processed_locations,
                 'raw_data_locations': {
                     'forecast': f"s3://{BUCKET}/{forecast_key}",
                     'alerts': f"s3://{BUCKET}/{alert_key}"
                 },
-                'cleanup_stats': {
-                    'deleted_forecast_files': deleted_forecast,
-                    'deleted_alert_files': deleted_alerts,
-                    'deleted_processed_files': deleted_processed
-                }
+                'cleanup_stats': {}
             })
         }
         